@@ -3,9 +3,10 @@
 # Email: danielcogswell@ses.ai
 
 import mmap
-import struct
+import time
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
 # Names for data fields
@@ -15,6 +16,89 @@ rec_columns = [
     'Charge_Energy(mWh)', 'Discharge_Energy(mWh)', 'Timestamp']
 aux_columns = ['Index', 'Aux', 'T']
 
+# Layout of the fixed length data and auxiliary records
+rec_dtype = np.dtype({
+    'names': [
+        'tag', 'Index', 'Cycle', 'Step', 'Status', 'Time', 'Voltage',
+        'Current', 'Charge_capacity', 'Discharge_capacity', 'Charge_energy',
+        'Discharge_energy', 'Y', 'M', 'D', 'h', 'm', 's', 'Timestamp',
+        'Range', 'tail'],
+    'formats': [
+        '<u2', '<u4', 'u1', '<u4', 'u1', '<u8', '<i4', '<i4', '<i8', '<i8',
+        '<i8', '<i8', '<u2', 'u1', 'u1', 'u1', 'u1', 'u1', '<u8', '<i4',
+        '<u4'],
+    'offsets': [
+        0, 2, 6, 10, 12, 14, 22, 26, 38, 46, 54, 62, 70, 72, 73, 74, 75, 76,
+        70, 78, 82],
+    'itemsize': 86})
+aux_dtype = np.dtype({
+    'names': ['tag', 'Aux', 'Index', 'T', 'tail'],
+    'formats': ['u1', 'u1', '<u4', '<i2', '<u4'],
+    'offsets': [0, 1, 2, 34, 82],
+    'itemsize': 86})
+
+# Dictionary mapping Status integer to string
+state_dict = {
+    1: 'CC_Chg',
+    2: 'CC_DChg',
+    3: 'CV_Chg',
+    4: 'Rest',
+    5: 'Cycle',
+    7: 'CCCV_Chg',
+    10: 'CR_DChg',
+    13: 'Pause',
+    17: 'SIM',
+    19: 'CV_DChg',
+    20: 'CCCV_DChg'
+}
+
+# Categories of the Status field and a lookup from Status integer to code
+status_categories = sorted(state_dict.values())
+status_codes = np.full(256, -1, dtype=np.int8)
+status_codes[list(state_dict)] = [
+    status_categories.index(v) for v in state_dict.values()]
+
+# Status integers of charge and discharge steps used to count cycles
+chg_states = [k for k, v in state_dict.items() if v in ['CC_Chg', 'CCCV_Chg']]
+dchg_states = [k for k, v in state_dict.items() if 'DChg' in v or v == 'SIM']
+
+# Define field scaling based on instrument Range setting
+multiplier_dict = {
+    -200000: 1e-2,
+    -100000: 1e-2,
+    -60000: 1e-2,
+    -30000: 1e-2,
+    -50000: 1e-2,
+    -20000: 1e-2,
+    -10000: 1e-2,
+    -6000: 1e-2,
+    -5000: 1e-2,
+    -3000: 1e-2,
+    -1000: 1e-2,
+    -500: 1e-3,
+    -100: 1e-3,
+    0: 0,
+    10: 1e-3,
+    100: 1e-2,
+    200: 1e-2,
+    1000: 1e-1,
+    6000: 1e-1,
+    12000: 1e-1,
+    50000: 1e-1,
+    60000: 1e-1,
+}
+
+# Sorted Range values and their multipliers for vectorized lookup
+range_keys = np.array(sorted(multiplier_dict), dtype=np.int32)
+range_multipliers = np.array([multiplier_dict[k] for k in range_keys])
+
+# Range of datetime64[ns] in whole seconds
+ns_bounds = (np.iinfo(np.int64).min // 10**9 + 1,
+             np.iinfo(np.int64).max // 10**9)
+
+# Latest Unix timestamp accepted by datetime, 9999-12-31T23:59:59
+max_timestamp = 253402300799
+
 
 def read(file):
     """
@@ -28,12 +112,21 @@ def read(file):
     with open(file, "rb") as f:
         mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         mm_size = mm.size()
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
 
         if mm.read(6) != b'NEWARE':
             raise ValueError(f"{file} does not appear to be a Neware file.")
 
-        # Try to find server and client version info
-        version_loc = mm.find(b'BTSServer')
+        # Identify the beginning of the data section
+        record_len = 86
+        identifier = b'\x00\x00\x00\x00\x55\x00'
+        header = _find_header(mm, identifier, record_len)
+        if header == -1:
+            raise EOFError(f"File {file} does not contain any valid records.")
+
+        # Try to find server and client version info in the file header
+        version_loc = mm.find(b'BTSServer', 0, header)
         if version_loc != -1:
             mm.seek(version_loc)
             server = mm.read(50).strip(b'\x00').decode()
@@ -44,214 +137,223 @@ def read(file):
         else:
             logging.info("File version not found!")
 
-        # Identify the beginning of the data section
-        record_len = 86
-        identifier = b'\x00\x00\x00\x00\x55\x00'
-        header = mm.find(identifier)
-        if header == -1:
-            raise EOFError(f"File {file} does not contain any valid records.")
-        while (((mm[header + 4 + record_len] != 85)
-                | (not _valid_record(mm[header+4:header+4+record_len])))
-               if header + 4 + record_len < mm_size
-               else False):
-            header = mm.find(identifier, header + 4)
-        mm.seek(header + 4)
-
         # Read data records
-        output = []
-        aux = []
-        while mm.tell() < mm_size:
-            bytes = mm.read(record_len)
-            if len(bytes) == record_len:
-
-                # Check for a data record
-                if (bytes[0:2] == b'\x55\x00'
-                        and bytes[82:87] == b'\x00\x00\x00\x00'):
-                    output.append(_bytes_to_list(bytes))
-
-                # Check for an auxiliary record
-                elif (bytes[0:1] == b'\x65'
-                      and bytes[82:87] == b'\x00\x00\x00\x00'):
-                    aux.append(_aux_bytes_to_list(bytes))
-
-    # Create DataFrame and sort by Index
-    df = pd.DataFrame(output, columns=rec_columns)
-    df.dropna(inplace=True)
-    df.drop_duplicates(inplace=True)
-
-    if not df.Index.is_monotonic_increasing:
-        df.sort_values('Index', inplace=True)
-
-    df.reset_index(drop=True, inplace=True)
-
-    # Join temperature data
-    aux_df = pd.DataFrame(aux, columns=aux_columns)
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            start = (header + 4) // mmap.PAGESIZE * mmap.PAGESIZE
+            mm.madvise(mmap.MADV_WILLNEED, start, mm_size - start)
+        num_records = (mm_size - header - 4) // record_len
+        records = np.frombuffer(mm, dtype=np.uint8,
+                                count=num_records*record_len,
+                                offset=header + 4)
+
+        # Identify data and auxiliary records
+        data = records.view(rec_dtype)
+        data = data[(data['tag'] == 0x0055) & (data['tail'] == 0)]
+        aux = records.view(aux_dtype)
+        aux = aux[(aux['tag'] == 0x65) & (aux['tail'] == 0)]
+
+    # Create DataFrame sorted by Index
+    df = _records_to_df(data)
+
+    # Join temperature data on the record Index
+    aux_df = _aux_records_to_df(aux)
     aux_df.drop_duplicates(inplace=True)
-    if not aux_df.empty:
-        for Aux in aux_df.Aux.unique():
-            df = df.join(aux_df.loc[aux_df.Aux == Aux, 'T'])
-            df.rename(columns={'T': f"T{Aux}"}, inplace=True)
+    Index = df.Index.to_numpy()
+    for Aux in aux_df.Aux.unique():
+        aux_Index = aux_df.loc[aux_df.Aux == Aux, 'Index'].to_numpy()
+        aux_T = aux_df.loc[aux_df.Aux == Aux, 'T'].to_numpy()
+
+        pos = np.searchsorted(Index, aux_Index)
+        match = pos < len(Index)
+        match[match] = Index[pos[match]] == aux_Index[match]
+
+        T = np.full(len(df), np.nan, dtype=np.float32)
+        T[pos[match]] = aux_T[match]
+        df[f"T{Aux}"] = T
 
     # Postprocessing
     df.Step = _count_changes(df.Step)
-    df.Cycle = _generate_cycle_number(df)
-
-    # Define precision of fields
-    dtype_dict = {
-        'Index': 'uint32',
-        'Cycle': 'uint16',
-        'Step': 'uint32',
-        'Status': 'category',
-        'Time': 'float32',
-        'Voltage': 'float32',
-        'Current(mA)': 'float32',
-        'Charge_Capacity(mAh)': 'float32',
-        'Discharge_Capacity(mAh)': 'float32',
-        'Charge_Energy(mWh)': 'float32',
-        'Discharge_Energy(mWh)': 'float32'
-    }
-    df = df.astype(dtype=dtype_dict)
+    df.Cycle = _generate_cycle_number(df.Status)
+    df.Status = _status_to_categorical(df.Status.to_numpy())
 
     return(df)
 
 
-def _valid_record(bytes):
-    """Helper function to identify a valid record"""
-    # Check for a non-zero Status
-    [Status] = struct.unpack('<B', bytes[12:13])
-    return(Status != 0)
-
-
-def _bytes_to_list(bytes):
-    """Helper function for interpreting a byte string"""
-    # Dictionary mapping Status integer to string
-    state_dict = {
-        1: 'CC_Chg',
-        2: 'CC_DChg',
-        3: 'CV_Chg',
-        4: 'Rest',
-        5: 'Cycle',
-        7: 'CCCV_Chg',
-        10: 'CR_DChg',
-        13: 'Pause',
-        17: 'SIM',
-        19: 'CV_DChg',
-        20: 'CCCV_DChg'
-    }
-
-    # Extract fields from byte string
-    [Index, Cycle] = struct.unpack('<IB', bytes[2:7])
-    [Step] = struct.unpack('<I', bytes[10:14])
-    [Status, Jump, Time] = struct.unpack('<BBQ', bytes[12:22])
-    [Voltage, Current] = struct.unpack('<ii', bytes[22:30])
-    [Charge_capacity, Discharge_capacity] = struct.unpack('<qq', bytes[38:54])
-    [Charge_energy, Discharge_energy] = struct.unpack('<qq', bytes[54:70])
-    [Y, M, D, h, m, s] = struct.unpack('<HBBBBB', bytes[70:77])
-    [Range] = struct.unpack('<i', bytes[78:82])
+def read_many(files, max_workers=None):
+    """
+    Function to read several Neware nda binary files concurrently.
 
+    Args:
+        files (list): Names of .nda files to read
+        max_workers (int): Maximum number of threads, defaults to the
+            ThreadPoolExecutor default
+    Returns:
+        dfs (list): DataFrames for each file, in the same order as files
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return(list(executor.map(read, files)))
+
+
+def _find_header(mm, identifier, record_len, chunk=1 << 20):
+    """
+    Locate the identifier preceding the first valid data record. The file is
+    searched in chunks so that only the beginning is scanned in most cases.
+    """
+    a = np.frombuffer(mm, dtype=np.uint8)
+    n = len(identifier)
+    for start in range(0, len(a), chunk):
+        window = a[start:start + chunk + n - 1]
+
+        # Candidate offsets matching the identifier
+        pos = np.flatnonzero(window[4:len(window) - 1] == identifier[4])
+        for i in [0, 1, 2, 3, 5]:
+            pos = pos[window[pos + i] == identifier[i]]
+        pos += start
+
+        # A valid record has a non-zero Status and is followed by a record
+        valid = pos + 4 + record_len >= len(a)
+        pos_ = pos[~valid]
+        valid[~valid] = ((a[pos_ + 4 + record_len] == 85)
+                         & (a[pos_ + 4 + 12] != 0))
+        if valid.any():
+            return(pos[valid][0])
+    return(-1)
+
+
+def _range_to_multiplier(Range):
+    """Helper function to look up the field scaling for each Range"""
+    pos = np.searchsorted(range_keys, Range).clip(0, len(range_keys) - 1)
+    unknown = range_keys[pos] != Range
+    if unknown.any():
+        raise KeyError(Range[unknown][0].item())
+    return(range_multipliers[pos])
+
+
+def _status_to_categorical(status):
+    """Helper function to convert Status integers to a Categorical"""
+    codes = status_codes[status]
+    if (codes < 0).any():
+        raise KeyError(status[codes < 0][0].item())
+    Status = pd.Categorical.from_codes(codes, categories=status_categories)
+    return(Status.remove_unused_categories())
+
+
+def _to_datetime(records):
+    """Convert date to datetime. Try Unix timestamp on failure."""
+    Y, M, D, h, m, s = (
+        records[f].astype(np.int64) for f in ['Y', 'M', 'D', 'h', 'm', 's'])
+
+    # Assemble dates from the calendar fields
+    month = ((Y - 1970)*12 + M - 1).astype('datetime64[M]')
+    days_in_month = ((month + 1).astype('datetime64[D]')
+                     - month.astype('datetime64[D]')).astype(np.int64)
+    Date = ((month.astype('datetime64[D]') + (D - 1)).astype('datetime64[s]')
+            + (h*3600 + m*60 + s))
+
+    # Fall back to a Unix timestamp for invalid dates
+    invalid = ~((Y >= 1) & (Y <= 9999) & (M >= 1) & (M <= 12) & (D >= 1)
+                & (D <= days_in_month) & (h < 24) & (m < 60) & (s < 60))
+    if invalid.any():
+        Timestamp = records['Timestamp'][invalid]
+        if (Timestamp > max_timestamp).any():
+            raise ValueError(
+                f"Timestamp {Timestamp[Timestamp > max_timestamp][0]} "
+                "is out of range")
+        Timestamp = Timestamp.astype(np.int64)
+        Date[invalid] = (Timestamp + _utc_offset(Timestamp)).astype(
+            'datetime64[s]')
+
+    # Use microsecond precision for dates outside the nanosecond range
+    seconds = Date.astype(np.int64)
+    if ((seconds < ns_bounds[0]) | (seconds > ns_bounds[1])).any():
+        return(Date.astype('datetime64[us]'))
+    return(Date.astype('datetime64[ns]'))
+
+
+def _utc_offset(Timestamp):
+    """Local UTC offset in seconds, evaluated once per quarter hour"""
+    quarter, inverse = np.unique(Timestamp // 900, return_inverse=True)
+    offset = [time.localtime(q*900).tm_gmtoff for q in quarter.tolist()]
+    return(np.array(offset, dtype=np.int64)[inverse])
+
+
+def _records_to_df(records):
+    """Helper function for interpreting an array of data records"""
     # Index should not be zero
-    if Index == 0:
-        return([])
-
-    # Convert date to datetime. Try Unix timestamp on failure.
-    try:
-        Date = datetime(Y, M, D, h, m, s)
-    except ValueError:
-        [Timestamp] = struct.unpack('<Q', bytes[70:78])
-        Date = datetime.fromtimestamp(Timestamp)
-
-    # Define field scaling based on instrument Range setting
-    multiplier_dict = {
-        -200000: 1e-2,
-        -100000: 1e-2,
-        -60000: 1e-2,
-        -30000: 1e-2,
-        -50000: 1e-2,
-        -20000: 1e-2,
-        -10000: 1e-2,
-        -6000: 1e-2,
-        -5000: 1e-2,
-        -3000: 1e-2,
-        -1000: 1e-2,
-        -500: 1e-3,
-        -100: 1e-3,
-        0: 0,
-        10: 1e-3,
-        100: 1e-2,
-        200: 1e-2,
-        1000: 1e-1,
-        6000: 1e-1,
-        12000: 1e-1,
-        50000: 1e-1,
-        60000: 1e-1,
-    }
-    multiplier = multiplier_dict[Range]
-
-    # Create a dictionary for the record
-    list = [
-        Index,
-        Cycle + 1,
-        Step,
-        state_dict[Status],
-        Time/1000,
-        Voltage/10000,
-        Current*multiplier,
-        Charge_capacity*multiplier/3600,
-        Discharge_capacity*multiplier/3600,
-        Charge_energy*multiplier/3600,
-        Discharge_energy*multiplier/3600,
-        Date
-    ]
-    return(list)
-
-
-def _aux_bytes_to_list(bytes):
-    """Helper function for intepreting auxiliary records"""
-    [Aux] = struct.unpack('<B', bytes[1:2])
-    [Index, Cycle] = struct.unpack('<IB', bytes[2:7])
-    [T] = struct.unpack('<h', bytes[34:36])
-
-    list = [
-        Index,
-        Aux,
-        T/10
-    ]
-
-    return(list)
-
-
-def _generate_cycle_number(df):
+    records = records[records['Index'] != 0]
+
+    # Keep the first record of each Index and sort
+    if not (np.diff(records['Index'].astype(np.int64)) > 0).all():
+        _, keep = np.unique(records['Index'], return_index=True)
+        records = records[keep]
+
+    # Capacity and energy are integer counts scaled by the Range multiplier
+    multiplier = _range_to_multiplier(records['Range'])
+    per_hour = multiplier/3600
+    Charge_capacity = (records['Charge_capacity']*per_hour).astype(np.float32)
+    Discharge_capacity = (records['Discharge_capacity']*per_hour).astype(
+        np.float32)
+    Charge_energy = (records['Charge_energy']*per_hour).astype(np.float32)
+    Discharge_energy = (records['Discharge_energy']*per_hour).astype(
+        np.float32)
+
+    # Create a DataFrame from the record fields with their final precision
+    df = pd.DataFrame({
+        'Index': records['Index'],
+        'Cycle': records['Cycle'].astype(np.uint16) + 1,
+        'Step': records['Step'],
+        'Status': records['Status'],
+        'Time': (records['Time']/1000).astype(np.float32),
+        'Voltage': (records['Voltage']/10000).astype(np.float32),
+        'Current(mA)': (records['Current']*multiplier).astype(np.float32),
+        'Charge_Capacity(mAh)': Charge_capacity,
+        'Discharge_Capacity(mAh)': Discharge_capacity,
+        'Charge_Energy(mWh)': Charge_energy,
+        'Discharge_Energy(mWh)': Discharge_energy,
+        'Timestamp': _to_datetime(records)
+    }, columns=rec_columns)
+    return(df)
+
+
+def _aux_records_to_df(records):
+    """Helper function for intepreting an array of auxiliary records"""
+    df = pd.DataFrame({
+        'Index': records['Index'],
+        'Aux': records['Aux'],
+        'T': (records['T']/10).astype(np.float32)
+    }, columns=aux_columns)
+    return(df)
+
+
+def _generate_cycle_number(status):
     """
     Generate a cycle number to match Neware. A new cycle starts with a charge
     step after there has previously been a discharge.
     """
+    status = status.to_numpy()
 
     # Identify the beginning of charge steps
-    chg = (df.Status == 'CCCV_Chg') | (df.Status == 'CC_Chg')
-    chg = (chg - chg.shift()).clip(0)
-    chg.iat[0] = 1
+    chg = np.isin(status, chg_states)
+    chg[1:] &= ~chg[:-1]
+    chg[0] = True
+    chg = np.flatnonzero(chg)
 
-    # Convert to numpy arrays
-    chg = chg.values
-    status = df.Status.values
+    # Count the discharge records preceding each row
+    dchg = np.isin(status, dchg_states)
+    dchg = np.cumsum(dchg) - dchg
 
     # Increment the cycle at a charge step after there has been a discharge
-    cyc = 1
-    dchg = False
-    for n in range(len(chg)):
-        if chg[n] & dchg:
-            cyc += 1
-            dchg = False
-        elif 'DChg' in status[n] or status[n] == 'SIM':
-            dchg = True
-        chg[n] = cyc
+    inc = np.zeros(len(status), dtype=np.uint16)
+    inc[chg[1:]] = np.diff(dchg[chg]) > 0
 
-    return(chg)
+    return(np.cumsum(inc, dtype=np.uint16) + 1)
 
 
 def _count_changes(series):
     """Enumerate the number of value changes in a series"""
-    a = series.diff()
-    a.iloc[0] = 1
-    a.iloc[-1] = 0
-    return((abs(a) > 0).cumsum())
+    a = series.to_numpy()
+    changes = np.empty(len(a), dtype=bool)
+    np.not_equal(a[1:], a[:-1], out=changes[1:])
+    changes[0] = True
+    changes[-1] = False
+    return(pd.Series(changes.cumsum(dtype=np.uint32), index=series.index))
@@ -24,7 +24,7 @@ setuptools.setup(
     license='BSD-3-Clause',
     packages=['NewareNDA'],
     scripts=['bin/NewareNDA-cli.py'],
-    install_requires=['pandas'],
+    install_requires=['numpy', 'pandas'],
     python_requires='>=3.6',
     classifiers=[
         "Programming Language :: Python :: 3",